@@ -25,6 +25,13 @@ limiter = Limiter(
     strategy="fixed-window"
 )
 
+# Startup migrations: bump SCHEMA_VERSION whenever the PostgreSQL schema/pgvector block in create_app changes.
+# Workers serialize on the advisory lock so only one of them runs the maintenance block per boot.
+SCHEMA_VERSION = 5
+MIGRATION_LOCK_ID = 81734213
+# Held by the worker rebuilding an empty vector store, so only one of them re-embeds
+REBUILD_LOCK_ID = 81734214
+
 # Admin Exemption: Admins are never rate limited
 @limiter.request_filter
 def admin_whitelist():
@@ -87,39 +94,44 @@ def create_app(config_class=Config):
         from config import Config
 
         # Robust Database Migrations and Indexing
+        from sqlalchemy import text
+        lock_conn = None
         try:
-            from sqlalchemy import text
             eng = db.session.get_bind()
             dialect = eng.dialect.name
             
-            # 1. Performance Indexes (CRITICAL)
+            # 0. Single-runner guard + schema version short-circuit (PostgreSQL only)
+            run_pg_maintenance = False
+            schema_current = False
+            critical_indexes_ok = False
             if 'postgresql' in dialect:
-                print("Ensuring database indexes for high performance...")
-                try:
-                    # Index for fast retrieval from document chunks
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_document_chunks_document_id ON public.document_chunks (document_id)"))
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_document_chunks_comp_search ON public.document_chunks (document_id, chunk_index)"))
-                    
-                    # Indexes for user chat history and session management
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_chat_messages_user_id ON public.chat_messages (user_id)"))
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_chat_messages_session_id ON public.chat_messages (session_id)"))
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_chat_messages_created_at ON public.chat_messages (created_at DESC)"))
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_id ON public.chat_sessions (user_id)"))
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at ON public.chat_sessions (updated_at DESC)"))
-                    
-                    # Indexes for dropdowns and filters
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_filter_options_category ON public.filter_options (category)"))
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_filter_options_parent_id ON public.filter_options (parent_id)"))
-                    
-                    # Indexes for filtered document lookups
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_documents_filters ON public.documents (course, semester, subject)"))
-                    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_documents_uploaded_by ON public.documents (uploaded_by)"))
-                    
+                lock_conn = eng.connect()
+                run_pg_maintenance = bool(lock_conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {'k': MIGRATION_LOCK_ID}).scalar())
+                # Session-level lock survives the commit; don't leave this connection idle in transaction
+                # (CREATE INDEX CONCURRENTLY would otherwise wait on it)
+                lock_conn.commit()
+                if run_pg_maintenance:
+                    from app.utils.db_maintenance import pgvector_supports_halfvec
+                    db.session.execute(text("CREATE TABLE IF NOT EXISTS public.schema_meta (version INTEGER NOT NULL)"))
+                    # Search mode match_documents was created with; the deferred HNSW build follows it
+                    db.session.execute(text("ALTER TABLE public.schema_meta ADD COLUMN IF NOT EXISTS use_halfvec BOOLEAN"))
+                    stored = db.session.execute(text("SELECT version, use_halfvec FROM public.schema_meta ORDER BY version DESC LIMIT 1")).first()
+                    stored_version, stored_halfvec = (stored[0], stored[1]) if stored else (0, None)
+                    # A pgvector upgrade/downgrade changes the mode: re-run the block so function and index agree
+                    schema_current = stored_version >= SCHEMA_VERSION and stored_halfvec == pgvector_supports_halfvec(db.session)
                     db.session.commit()
-                    print("Database indexes verified")
-                except Exception as ex:
-                    db.session.rollback()
-                    print(f"Indexing warning: {ex}")
+                else:
+                    print("Startup migrations are running in another worker, skipping")
+            
+            # 1. Performance Indexes (CRITICAL)
+            # Built CONCURRENTLY on autocommit connections so writers are never blocked during boot.
+            # Only the chat-path index is built here; the rest are deferred to the background worker below.
+            if run_pg_maintenance:
+                print("Ensuring database indexes for high performance...")
+                from app.utils.db_maintenance import CRITICAL_INDEXES, ensure_index_concurrently
+                built = sum(1 for name, definition in CRITICAL_INDEXES if ensure_index_concurrently(eng, name, definition))
+                critical_indexes_ok = built == len(CRITICAL_INDEXES)
+                print(f"Database indexes verified ({built}/{len(CRITICAL_INDEXES)})")
 
             # 2. Schema Migrations (Conditional to avoid locks)
             if 'sqlite' in dialect:
@@ -143,7 +155,9 @@ def create_app(config_class=Config):
                 if 'structure_json' not in doc_cols:
                     db.session.execute(text("ALTER TABLE documents ADD COLUMN structure_json TEXT"))
                 db.session.commit()
-            elif 'postgresql' in dialect:
+            elif run_pg_maintenance and schema_current:
+                print(f"PostgreSQL schema version {SCHEMA_VERSION} already applied")
+            elif run_pg_maintenance:
                 print("Verifying PostgreSQL schema...")
                 # Check for column existence first to avoid expensive/blocking ALTER TABLE locks
                 check_sql = text("""
@@ -217,6 +231,19 @@ def create_app(config_class=Config):
                     print("Checking Supabase pgvector extension and tables...")
                     # 1. Enable extension
                     db.session.execute(text('CREATE EXTENSION IF NOT EXISTS vector'))
+                    # pgvector >= 0.7 can index a half-precision copy of each vector: half the index size
+                    # and half the bytes scanned per query, with negligible recall loss for MiniLM embeddings
+                    use_halfvec = pgvector_supports_halfvec(db.session)
+                    if use_halfvec:
+                        # Rows are unit length (normalized on insert, older rows backfilled below), so the
+                        # cheaper inner product ranks identically to cosine
+                        similarity_expr = '-(embeddings.embedding <#> query_embedding)'
+                        order_expr = 'embeddings.embedding::halfvec(384) <#> query_embedding::halfvec(384)'
+                    else:
+                        # No l2_normalize before pgvector 0.7, so rows written before insert-time normalization
+                        # can't be backfilled here; cosine doesn't depend on vector length
+                        similarity_expr = '1 - (embeddings.embedding <=> query_embedding)'
+                        order_expr = 'embeddings.embedding <=> query_embedding'
                     
                     # 2. Create embeddings table
                     db.session.execute(text('''
@@ -227,6 +254,32 @@ def create_app(config_class=Config):
                             embedding VECTOR(384)
                         )
                     '''))
+
+                    # The one-time table-wide statements below outlast the pool's default statement_timeout
+                    db.session.execute(text("SET LOCAL statement_timeout = 0"))
+
+                    # Rebuild generations: search only serves rows of vector_generation.active, so a rebuild
+                    # can write its rows alongside and swap them in by updating this single row.
+                    # New rows default to the active generation; the constant 0 default for existing rows
+                    # avoids a table rewrite.
+                    db.session.execute(text("CREATE TABLE IF NOT EXISTS public.vector_generation (active BIGINT NOT NULL, pending BIGINT)"))
+                    db.session.execute(text("INSERT INTO public.vector_generation (active) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM public.vector_generation)"))
+                    db.session.execute(text(
+                        "CREATE OR REPLACE FUNCTION public.active_vector_generation() RETURNS BIGINT "
+                        "LANGUAGE sql STABLE AS $$ SELECT active FROM public.vector_generation LIMIT 1 $$"
+                    ))
+                    db.session.execute(text("ALTER TABLE public.embeddings ADD COLUMN IF NOT EXISTS generation BIGINT NOT NULL DEFAULT 0"))
+                    db.session.execute(text("ALTER TABLE public.embeddings ALTER COLUMN generation SET DEFAULT public.active_vector_generation()"))
+                    # Rows tagged by the earlier metadata-based scheme belong to an unfinished rebuild
+                    db.session.execute(text("DELETE FROM public.embeddings WHERE metadata ? 'rebuild_pending'"))
+
+                    # One-time backfill (guarded by SCHEMA_VERSION): unit-normalize rows stored before
+                    # vectors were normalized on insert, otherwise inner product mis-ranks them
+                    if use_halfvec:
+                        db.session.execute(text("""
+                            UPDATE public.embeddings SET embedding = l2_normalize(embedding)
+                            WHERE vector_norm(embedding) > 0 AND abs(vector_norm(embedding) - 1) > 1e-4
+                        """))
                     
                     # 3. Create search function (idempotent CREATE OR REPLACE)
                     # First drop any overloaded versions to avoid PGSRT203 conflicts
@@ -253,15 +306,27 @@ def create_app(config_class=Config):
                         )
                         LANGUAGE plpgsql
                         AS $$
+                        DECLARE
+                            active_gen BIGINT;
+                            rebuilding BOOLEAN;
                         BEGIN
+                            SELECT v.active, v.pending IS NOT NULL INTO active_gen, rebuilding FROM vector_generation v LIMIT 1;
+                            IF rebuilding THEN
+                                -- An in-progress rebuild's rows share the HNSW graph but are filtered out below,
+                                -- so widen the candidate list to still fill match_count
+                                PERFORM set_config('hnsw.ef_search',
+                                    least(1000, 2 * coalesce(current_setting('hnsw.ef_search', true), '40')::int)::text, true);
+                            END IF;
+
                             RETURN QUERY
                             SELECT
                                 embeddings.id,
                                 embeddings.content,
                                 embeddings.metadata,
-                                1 - (embeddings.embedding <=> query_embedding) AS similarity
+                                ''' + similarity_expr + ''' AS similarity
                             FROM embeddings
-                            WHERE 1 - (embeddings.embedding <=> query_embedding) > match_threshold
+                            WHERE ''' + similarity_expr + ''' > match_threshold
+                                AND embeddings.generation = active_gen
                                 AND (
                                     filter = '{}'
                                     OR (
@@ -269,23 +334,33 @@ def create_app(config_class=Config):
                                         OR (embeddings.metadata @> filter)
                                     )
                                 )
-                            ORDER BY embeddings.embedding <=> query_embedding
+                            ORDER BY ''' + order_expr + '''
                             LIMIT match_count;
                         END;
                         $$;
                     '''))
                     
-                    # 4. Create Index
-                    db.session.execute(text('CREATE INDEX IF NOT EXISTS embeddings_hnsw_idx ON public.embeddings USING hnsw (embedding vector_cosine_ops)'))
-                    
-                    # 5. 🔥 CRITICAL: Refresh PostgREST schema cache so Supabase client sees the new table immediately
+                    # 4. 🔥 CRITICAL: Refresh PostgREST schema cache so Supabase client sees the new table immediately
                     try:
                         db.session.execute(text("NOTIFY pgrst, 'reload_schema'"))
                     except Exception:
                         pass
                         
                     db.session.commit()
+
+                    # 5. The HNSW index (matching order_expr) is built by build_deferred_indexes once the app
+                    # is serving, since a full ANN build on an existing table would block boot
                     print("Supabase pgvector setup complete")
+
+                    # Record the applied version only when every step, including the critical indexes, succeeded;
+                    # otherwise the next boot runs the block again
+                    if critical_indexes_ok:
+                        db.session.execute(text("DELETE FROM public.schema_meta"))
+                        db.session.execute(text("INSERT INTO public.schema_meta (version, use_halfvec) VALUES (:v, :h)"),
+                                           {'v': SCHEMA_VERSION, 'h': use_halfvec})
+                        db.session.commit()
+                    else:
+                        print("Critical indexes incomplete; schema version left unrecorded so the next boot retries")
                 except Exception as se:
                     db.session.rollback()
                     print(f"Supabase setup error: {se}")
@@ -294,6 +369,14 @@ def create_app(config_class=Config):
             db.session.rollback()
             print(f"Startup maintenance warning: {e}")
             logging.warning(f"Startup maintenance warning: {e}")
+        finally:
+            if lock_conn is not None:
+                try:
+                    lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {'k': MIGRATION_LOCK_ID})
+                except Exception as ue:
+                    logging.warning(f"Failed to release migration lock: {ue}")
+                finally:
+                    lock_conn.close()
 
         admin = User.query.filter_by(email=Config.ADMIN_EMAIL).first()
         if not admin:
@@ -318,22 +401,44 @@ def create_app(config_class=Config):
         
         # --- Persistent Vector Store Setup ---
         # With Supabase, we DON'T need to rebuild on every startup as it's persistently stored in the DB.
-        # Clearing and rebuilding on startup is slow, expensive (API calls), and can cause data loss.
-        print("Checking vector store status...")
-        from app.services.vector_store import VectorStore
-        vector_store = VectorStore.get_instance()
-        
-        try:
-            current_stats = vector_store.get_stats()
-            print(f"Vector store stats: {current_stats}")
-            if current_stats['total_vectors'] == 0:
-                print("WARNING: Vector store is empty! Use Admin panel to sync documents.")
-                logging.warning("Vector store is empty on startup.")
-            else:
-                print(f"Vector store ready with {current_stats['total_vectors']} vectors")
-        except Exception as e:
-            print(f"Vector store check failed: {e}")
-            logging.warning(f"Vector store check failed: {e}")
+        # The status check (and an optional rebuild of an empty store) runs in a background thread
+        # so it never delays app boot; chat requests get a 503 while a rebuild is in progress.
+        def warm_vector_store():
+            with app.app_context():
+                try:
+                    from app.services.vector_store import VectorStore
+                    from app.models import DocumentChunk
+                    vector_store = VectorStore.get_instance()
+                    current_stats = vector_store.get_stats()
+                    print(f"Vector store stats: {current_stats}")
+                    if current_stats['total_vectors'] > 0:
+                        print(f"Vector store ready with {current_stats['total_vectors']} vectors")
+                    elif app.config.get('AUTO_REBUILD_INDEX') and DocumentChunk.query.first() is not None:
+                        logging.warning("Vector store is empty on startup. Rebuilding from document chunks in background...")
+                        from sqlalchemy import text
+                        from app.services.index_rebuilder import rebuild_index_from_db
+                        # Only one worker may rebuild; the others keep serving from the shared table
+                        with db.engine.connect() as lock_conn:
+                            got_lock = lock_conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {'k': REBUILD_LOCK_ID}).scalar()
+                            # Session-level lock survives the commit; don't sit idle in transaction for the whole rebuild
+                            lock_conn.commit()
+                            if got_lock:
+                                try:
+                                    rebuild_index_from_db()
+                                finally:
+                                    lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {'k': REBUILD_LOCK_ID})
+                                    lock_conn.commit()
+                    else:
+                        print("WARNING: Vector store is empty! Use Admin panel to sync documents.")
+                        logging.warning("Vector store is empty on startup.")
+                except Exception as e:
+                    print(f"Vector store check failed: {e}")
+                    logging.warning(f"Vector store check failed: {e}")
+                finally:
+                    db.session.remove()
+
+        threading.Thread(target=warm_vector_store, daemon=True).start()
+        print("Vector store warm-up scheduled in background...")
         
         # Start background workers (Web Source Auto-Refresh) - delayed start to not block app startup
         try:
@@ -344,6 +449,17 @@ def create_app(config_class=Config):
             
             def delayed_worker_start():
                 time.sleep(10)  # Wait 10 seconds for app to fully start
+                # Non-critical indexes catch up once the app is already serving requests
+                try:
+                    from app.utils.db_maintenance import build_deferred_indexes
+                    with app.app_context():
+                        build_deferred_indexes(
+                            db.engine,
+                            hnsw_m=app.config['VECTOR_HNSW_M'],
+                            hnsw_ef_construction=app.config['VECTOR_HNSW_EF_CONSTRUCTION']
+                        )
+                except Exception as e:
+                    logging.warning(f"Deferred index build failed: {e}")
                 try:
                     WebSourceRefresher.start_worker(app)
                     print("Web Source Auto-Refresher started.")
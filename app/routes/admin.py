@@ -204,20 +204,20 @@ def delete_filter_option(opt_id):
             supa = SupabaseService()
             vs = VectorStore.get_instance()
             
+            # 2.1 Remove from Vector Store (embeddings) for all matched documents in one statement
+            try:
+                vs.remove_documents([doc.id for doc in docs_to_delete])
+            except Exception as ve:
+                logging.warning(f"Failed to remove vectors for {len(docs_to_delete)} docs: {ve}")
+            
             for doc in docs_to_delete:
-                # 2.1 Remove from Supabase Storage
+                # 2.2 Remove from Supabase Storage
                 if doc.file_path and not str(doc.file_path).startswith(('http://', 'https://')):
                     try:
                         supa.delete_file(doc.file_path)
                     except Exception as se:
                         logging.warning(f"Failed to delete storage file {doc.file_path}: {se}")
                 
-                # 2.2 Remove from Vector Store (embeddings)
-                try:
-                    vs.remove_document(doc.id)
-                except Exception as ve:
-                    logging.warning(f"Failed to remove vectors for doc {doc.id}: {ve}")
-                
                 # 2.3 DB cleanup (Chunks are handled by cascade in models, but we ensure order)
                 DocumentChunk.query.filter_by(document_id=doc.id).delete()
                 db.session.delete(doc)
@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, session, current_app
+from flask import Blueprint, request, jsonify, session, current_app, Response, stream_with_context
 from app import db, limiter
 from app.models import ChatMessage, ChatSession, User
 # Lazy imports to avoid circular dependency on startup
@@ -17,6 +17,25 @@ _SCRAPE_CACHE = {}
 _SCRAPE_CACHE_TIME = {}
 SCRAPE_CACHE_TTL = 3600 # 1 hour
 
+def _save_answer(user, session_id, question, answer, results):
+    """Persist a RAG answer together with the sources it was grounded on"""
+    new_msg = ChatMessage(
+        user_id=user.id,
+        session_id=session_id,
+        question=question,
+        answer=answer,
+        course=user.pref_course,
+        semester=user.pref_semester,
+        subject=user.pref_subject,
+        sources_json=json.dumps([{'filename': r.get('filename'), 'url': r.get('url')} for r in results])
+    )
+    db.session.add(new_msg)
+    db.session.commit()
+    return new_msg
+
+def _sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
 @chat_bp.route('/api/query', methods=['POST'])
 @limiter.limit("30 per hour")
 @login_required
@@ -95,6 +114,13 @@ def chat():
                 'sources': []
             })
 
+        # 2.15 Vector store may still be rebuilding after startup (in this or any other worker)
+        if vector_store.warming_up():
+            return jsonify({
+                'error': 'Knowledge base is warming up',
+                'message': 'The knowledge base is being rebuilt. Please try again in a moment.'
+            }), 503, {'Retry-After': '30'}
+
         # 2.2 Query Parameters & Rewriting
         course = (data.get('course') or user.pref_course or '').strip()
         semester = (data.get('semester') or user.pref_semester or '').strip()
@@ -273,9 +299,7 @@ def chat():
         if live_context:
             context = f"--- LIVE WEB DATA ---\n{live_context}\n\n--- STATIC KNOWLEDGE ---\n{context}"
 
-        answer = ai_service.generate_answer(
-            question, 
-            context,
+        answer_kwargs = dict(
             mode=mode,
             history=history,
             user_preferred_name=user.preferred_name,
@@ -284,20 +308,31 @@ def chat():
             subject=subject,
             syllabus_context=syllabus_structure
         )
+
+        # 3.9 Streaming (opt-in): send tokens as Server-Sent Events while the LLM decodes
+        if data.get('stream'):
+            def generate():
+                parts = []
+                try:
+                    for delta in ai_service.generate_answer_stream(question, context, **answer_kwargs):
+                        parts.append(delta)
+                        yield _sse({'delta': delta})
+                    new_msg = _save_answer(user, session_id, question, "".join(parts), results)
+                    yield _sse({'done': True, 'session_id': session_id, 'message_id': new_msg.id, 'sources': results})
+                except Exception as e:
+                    # Also reached when the LLM stream breaks mid-answer: the partial text is
+                    # neither saved nor confirmed with 'done'
+                    db.session.rollback()
+                    logging.error(f"Chat stream error: {e}", exc_info=True)
+                    yield _sse({'error': 'The answer was interrupted. Please try again.' if parts else 'Failed to generate answer'})
+
+            return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+        answer = ai_service.generate_answer(question, context, **answer_kwargs)
         
         # 4. Save Message
-        new_msg = ChatMessage(
-            user_id=user.id,
-            session_id=session_id,
-            question=question,
-            answer=answer,
-            course=user.pref_course,
-            semester=user.pref_semester,
-            subject=user.pref_subject,
-            sources_json=json.dumps([{'filename': r.get('filename'), 'url': r.get('url')} for r in results])
-        )
-        db.session.add(new_msg)
-        db.session.commit()
+        new_msg = _save_answer(user, session_id, question, answer, results)
         
         return jsonify({
             'answer': answer,
@@ -1,11 +1,156 @@
 from huggingface_hub import InferenceClient
 from config import Config
-from flask import current_app
+from flask import current_app, has_app_context
+import os
+import re
 import time
 import logging
 import json
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 __all__ = ['AIService', 'approx_tokens']
 
+# Small-talk detection tables, compiled once instead of on every chat message
+_SMALLTALK_PHRASES = frozenset([
+    "hi", "hello", "hey", "thanks", "thank you", "good morning", "good evening", "good afternoon",
+    "nice", "okay", "ok", "oka", "cool", "great", "excellent", "awesome", "perfect",
+    "wow", "i see", "understood", "got it", "fine", "yes", "no", "bye", "goodbye",
+    "hii", "hiii", "hiiii", "heyy", "heyyy", "helloo", "hellooo"
+])
+_GREETING_WORDS = frozenset(["hi", "hello", "hey", "hii", "hiii", "heyy", "heyyy", "yo", "sup", "greetings"])
+_NON_ALNUM_RE = re.compile(r'[\W_]+')
+# A single greeting word with any letters stretched, e.g. "heyyyy", "hiiii", "thaaank"
+_STRETCHED_GREETING_RE = re.compile(r'(?:h+(?:i+|e+(?:y+|l+o+)?)|t+h+a+n+k+)')
+
+# Embedding requests are I/O bound, so batches are sent to the HF API concurrently
+EMBEDDING_BATCH_SIZE = 32
+EMBEDDING_MAX_WORKERS = 8
+
+# Generation fallbacks, tried in order after the configured primary model
+_ANSWER_FALLBACK_MODELS = (
+    "Qwen/Qwen2.5-7B-Instruct",
+    "meta-llama/Llama-3.2-3B-Instruct",
+    "mistralai/Mistral-7B-Instruct-v0.3",
+    "Qwen/Qwen3-8B",
+)
+_SMALLTALK_FALLBACK_MODELS = (
+    "Qwen/Qwen3-4B-Instruct-2507",
+    "google/gemma-2-2b-it",
+    "Qwen/Qwen2.5-7B-Instruct",
+    "meta-llama/Llama-3.2-1B-Instruct",
+)
+CREDITS_DEPLETED_MESSAGE = "Your Hugging Face API monthly included credits are depleted. Please purchase pre-paid credits, upgrade your Hugging Face account to Pro, or configure another API token in your settings."
+
+# A model that was rejected outright (unknown / unsupported) is skipped for a while instead of being
+# retried on every request. Timeouts and overload are per-call and never put a model in cooldown,
+# so a short-timeout caller (query rewrite, small talk) can't knock the primary model off the answer path.
+MODEL_FAILURE_TTL = 300
+_model_failed_at = {}
+
+# Overall time for one fallback walk is GENERATION_BUDGET_FACTOR x the per-call timeout; once spent,
+# no further model or serverless retry is started
+GENERATION_BUDGET_FACTOR = 2
+
+def _is_credit_error(e):
+    err_str = str(e).lower()
+    return "402" in err_str or "payment required" in err_str or "credits" in err_str
+
+def _is_model_unavailable(e):
+    """Errors that recur for this model no matter who calls it, unlike timeouts or 503 loading"""
+    err_str = str(e).lower()
+    return ("404" in err_str or "not found" in err_str or "not supported" in err_str
+            or "model_not_supported" in err_str)
+
+def _candidate_models(primary, fallbacks):
+    """Primary + fallbacks, deduplicated, leaving out recently failed models (unless every one has failed)"""
+    models = list(dict.fromkeys(m for m in (primary, *fallbacks) if m))
+    now = time.monotonic()
+    healthy = [m for m in models if m not in _model_failed_at or now - _model_failed_at[m] >= MODEL_FAILURE_TTL]
+    return healthy or models
+
+@lru_cache(maxsize=16)
+def _inference_client(token, timeout=None, base_url=None):
+    """Reuse one InferenceClient per (token, timeout, base_url) instead of rebuilding it on every call"""
+    return InferenceClient(token=token, base_url=base_url, timeout=timeout)
+
+def _config(key):
+    """Read a setting from the active Flask app, falling back to the static Config"""
+    value = current_app.config.get(key) if has_app_context() else None
+    return value or getattr(Config, key, None)
+
+class _LocalEmbedder:
+    """
+    In-process sentence embeddings from an ONNX export of the embedding model, e.g.
+    `optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 --optimize O3`
+    followed by int8 quantization. Mean-pools the last hidden state like sentence-transformers.
+    """
+    def __init__(self, model_dir):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = os.path.join(model_dir, 'model_quantized.onnx')
+        if not os.path.exists(model_path):
+            model_path = os.path.join(model_dir, 'model.onnx')
+        self.session = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_length=256)
+        self.tokenizer.enable_padding()
+
+    def embed(self, texts):
+        all_embeddings = []
+        for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            encodings = self.tokenizer.encode_batch(texts[i:i + EMBEDDING_BATCH_SIZE])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            if 'token_type_ids' in self.input_names:
+                feeds['token_type_ids'] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+            output = self.session.run(None, feeds)[0]
+            if output.ndim == 3:
+                # Mean pooling over real (non-padding) tokens
+                mask = attention_mask[..., None].astype(np.float32)
+                output = (output * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            output = output / np.clip(np.linalg.norm(output, axis=1, keepdims=True), 1e-12, None)
+            all_embeddings.extend(output.tolist())
+        return all_embeddings
+
+# Loaded ONNX embedders by model dir; failed loads are retried after LOCAL_EMBEDDER_RETRY seconds
+# instead of being cached for the life of the process
+LOCAL_EMBEDDER_RETRY = 60
+_local_embedders = {}
+_local_embedder_failed_at = {}
+
+def _local_embedder(model_dir):
+    """Load the local ONNX embedder once per process; None when not configured or unavailable"""
+    if not model_dir:
+        return None
+    embedder = _local_embedders.get(model_dir)
+    if embedder is not None:
+        return embedder
+    failed_at = _local_embedder_failed_at.get(model_dir)
+    if failed_at is not None and time.monotonic() - failed_at < LOCAL_EMBEDDER_RETRY:
+        return None
+    try:
+        embedder = _LocalEmbedder(model_dir)
+        logging.info(f"Using local ONNX embedding model from {model_dir}")
+        _local_embedders[model_dir] = embedder
+        _local_embedder_failed_at.pop(model_dir, None)
+        return embedder
+    except Exception as e:
+        _local_embedder_failed_at[model_dir] = time.monotonic()
+        logging.warning(f"Local ONNX embedding model unavailable ({e}). Falling back to Hugging Face API.")
+        return None
+
+@lru_cache(maxsize=4096)
+def _embed_one(text, model, token):
+    """Memoized single-text embedding so repeated chat queries skip the HF round-trip"""
+    client = _inference_client(token, 60)
+    # Tuples keep cached vectors immutable; callers receive a fresh list
+    return tuple(AIService._embed_batch(client, [text], model)[0])
+
 def approx_tokens(text: str) -> int:
     """Rough estimate of tokens from text (1 word ~= 1.3 tokens)"""
     if not text: return 0
@@ -13,7 +158,7 @@ def approx_tokens(text: str) -> int:
 
 class AIService:
     @staticmethod
-    def _chat_completion_with_fallback(messages, model, token, max_tokens=1200, temperature=0.2, timeout=45):
+    def _chat_completion_with_fallback(messages, model, token, max_tokens=1200, temperature=0.2, timeout=45, deadline=None):
         """
         Run chat completion with a model.
         First tries the metered Inference Providers router.
@@ -22,7 +167,7 @@ class AIService:
         """
         # 1. Try metered Inference Providers router
         try:
-            client = InferenceClient(token=token, timeout=timeout)
+            client = _inference_client(token, timeout)
             response = client.chat_completion(
                 messages=messages,
                 model=model,
@@ -43,7 +188,7 @@ class AIService:
             
         # 2. Fallback to free Serverless Inference Hub
         base_url = f"https://api-inference.huggingface.co/models/{model}"
-        client_free = InferenceClient(token=token, base_url=base_url, timeout=timeout)
+        client_free = _inference_client(token, timeout, base_url)
         
         for attempt in range(5):
             try:
@@ -60,13 +205,43 @@ class AIService:
                     return out.strip()
             except Exception as free_ex:
                 free_err = str(free_ex).lower()
-                if ("loading" in free_err or "503" in free_err or "currently loading" in free_err) and attempt < 4:
-                    time.sleep(6 * (attempt + 1))
+                wait = 6 * (attempt + 1)
+                if (("loading" in free_err or "503" in free_err or "currently loading" in free_err) and attempt < 4
+                        and (deadline is None or time.monotonic() + wait < deadline)):
+                    time.sleep(wait)
                     continue
                 raise free_ex
                 
         raise RuntimeError(f"Model {model} failed on both metered router and free serverless endpoint.")
 
+    @staticmethod
+    def _generate_with_fallbacks(messages, models, token, label, timeout=45, **kwargs):
+        """
+        Try each model once with the same prompt; returns (text, credits_depleted).
+        Stops at the first credit error (credits belong to the token, so every other model would fail too)
+        and once GENERATION_BUDGET_FACTOR x timeout has elapsed.
+        """
+        deadline = time.monotonic() + GENERATION_BUDGET_FACTOR * timeout
+        for mdl in models:
+            if time.monotonic() >= deadline:
+                logging.warning(f"{label} gave up after its {GENERATION_BUDGET_FACTOR * timeout}s budget")
+                break
+            try:
+                out = AIService._chat_completion_with_fallback(
+                    messages=messages, model=mdl, token=token, timeout=timeout, deadline=deadline, **kwargs
+                )
+                if out and len(out.strip()) > 0:
+                    _model_failed_at.pop(mdl, None)
+                    return out.strip(), False
+            except Exception as e:
+                if _is_credit_error(e):
+                    logging.warning(f"{label} stopped at {mdl}: Hugging Face credits depleted")
+                    return None, True
+                if _is_model_unavailable(e):
+                    _model_failed_at[mdl] = time.monotonic()
+                logging.warning(f"{label} fallback {mdl} failed: {e}")
+        return None, False
+
     @staticmethod
     def rewrite_query(question, history):
         """Rewrite the user's question to be self-contained based on conversation history."""
@@ -82,7 +257,7 @@ class AIService:
 
         # Try Hugging Face first (Primary with robust fallbacks)
         try:
-            token = current_app.config.get("HUGGINGFACE_API_TOKEN") if current_app else Config.HUGGINGFACE_API_TOKEN
+            token = _config("HUGGINGFACE_API_TOKEN")
             
             import datetime
             current_time_str = datetime.datetime.now().strftime("%B %d, %Y (YYYY-MM-DD: %Y-%m-%d)")
@@ -92,95 +267,86 @@ class AIService:
                 {"role": "user", "content": f"History:\n{history_str}\n\nLatest Message: {question}\n\nStandalone Query:"}
             ]
             
-            hf_model = current_app.config.get("HF_LLM_MODEL") if current_app else Config.HF_LLM_MODEL
-            fallbacks = [
-                hf_model,
-                "Qwen/Qwen2.5-7B-Instruct",
-                "meta-llama/Llama-3.2-3B-Instruct",
-                "mistralai/Mistral-7B-Instruct-v0.3",
-                "Qwen/Qwen3-8B"
-            ]
-            
-            for mdl in fallbacks:
-                if not mdl: continue
-                try:
-                    result = AIService._chat_completion_with_fallback(
-                        messages=rewrite_messages,
-                        model=mdl,
-                        token=token,
-                        max_tokens=100,
-                        temperature=0.0,
-                        timeout=12
-                    )
-                    result = (result or "").strip().strip('"').strip("'").strip()
-                    if result and len(result) > 2:
-                        return result
-                except Exception as inner_ex:
-                    logging.warning(f"Hugging Face query rewrite fallback {mdl} failed: {inner_ex}")
-                    continue
+            models = _candidate_models(_config("HF_LLM_MODEL"), _ANSWER_FALLBACK_MODELS)
+            result, _ = AIService._generate_with_fallbacks(
+                rewrite_messages, models, token, "Hugging Face query rewrite",
+                max_tokens=100, temperature=0.0, timeout=12
+            )
+            result = (result or "").strip().strip('"').strip("'").strip()
+            if result and len(result) > 2:
+                return result
         except Exception as e:
             logging.warning(f"Hugging Face query rewrite failed: {e}")
                 
         return question
 
+    @staticmethod
+    def _embed_batch(client, batch, model):
+        """Embed one batch, backing off exponentially while the model loads or rate limits"""
+        for attempt in range(5):
+            try:
+                result = client.feature_extraction(batch, model=model)
+                
+                if hasattr(result, 'tolist'):
+                    res_list = result.tolist()
+                else:
+                    res_list = result
+                
+                if len(batch) == 1:
+                    if res_list and not isinstance(res_list[0], list):
+                        res_list = [res_list]
+                
+                if len(res_list) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, got {len(res_list)}")
+                    
+                return res_list
+                    
+            except Exception as e:
+                err_msg = str(e).lower()
+                logging.warning(f"Batch embedding attempt {attempt + 1} failed: {e}")
+                if attempt == 4:
+                    break
+                
+                if "loading" in err_msg or "503" in err_msg or "429" in err_msg or "rate limit" in err_msg:
+                    time.sleep(3 * (2 ** attempt))
+                else:
+                    time.sleep(3)
+        
+        raise RuntimeError(f"Embedding generation failed for a batch of text. Indexing aborted to prevent data corruption.")
+
     @staticmethod
     def get_embeddings(texts):
         if not texts:
             return []
-            
-        try:
-            token = current_app.config.get("HUGGINGFACE_API_TOKEN") if current_app else None
-        except Exception:
-            token = None
-            
-        client = InferenceClient(token=token or Config.HUGGINGFACE_API_TOKEN, timeout=60)
+        if isinstance(texts, str):
+            texts = [texts]
         
-        try:
-            emb_model = current_app.config.get("HF_EMBEDDING_MODEL") if current_app else None
-        except Exception:
-            emb_model = None
+        # Prefer the in-process ONNX model (no network round-trip); the HF API stays as fallback
+        local = _local_embedder(_config("HF_EMBEDDING_ONNX_DIR"))
+        if local is not None:
+            try:
+                return local.embed(list(texts))
+            except Exception as e:
+                logging.warning(f"Local embedding failed, falling back to Hugging Face API: {e}")
             
-        model = emb_model or Config.HF_EMBEDDING_MODEL
+        token = _config("HUGGINGFACE_API_TOKEN")
+        model = _config("HF_EMBEDDING_MODEL")
         
-        BATCH_SIZE = 16
-        all_embeddings = []
+        # Single texts (chat queries) go through the in-process LRU cache
+        if len(texts) == 1:
+            return [list(_embed_one(texts[0], model, token))]
         
-        for i in range(0, len(texts), BATCH_SIZE):
-            batch = texts[i:i + BATCH_SIZE]
-            
-            success = False
-            for attempt in range(5):
-                try:
-                    result = client.feature_extraction(batch, model=model)
-                    
-                    if hasattr(result, 'tolist'):
-                        res_list = result.tolist()
-                    else:
-                        res_list = result
-                    
-                    if len(batch) == 1:
-                        if res_list and not isinstance(res_list[0], list):
-                            res_list = [res_list]
-                    
-                    if len(res_list) != len(batch):
-                        raise ValueError(f"Expected {len(batch)} embeddings, got {len(res_list)}")
-                        
-                    all_embeddings.extend(res_list)
-                    success = True
-                    break 
-                        
-                except Exception as e:
-                    err_msg = str(e).lower()
-                    logging.warning(f"Batch embedding attempt {attempt + 1} failed: {e}")
-                    
-                    if "loading" in err_msg or "503" in err_msg:
-                        time.sleep((attempt + 1) * 6)
-                    else:
-                        time.sleep(3) 
-            
-            if not success:
-                logging.error(f"Failed to generate embeddings for batch starting at index {i}")
-                raise RuntimeError(f"Embedding generation failed for a batch of text. Indexing aborted to prevent data corruption.")
+        client = _inference_client(token, 60)
+        
+        batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+        if len(batches) == 1:
+            return AIService._embed_batch(client, batches[0], model)
+        
+        # Fan batches out across a small pool; map() keeps results in input order
+        all_embeddings = []
+        with ThreadPoolExecutor(max_workers=min(EMBEDDING_MAX_WORKERS, len(batches))) as pool:
+            for res_list in pool.map(lambda batch: AIService._embed_batch(client, batch, model), batches):
+                all_embeddings.extend(res_list)
                     
         return all_embeddings
 
@@ -276,7 +442,8 @@ class AIService:
         return text
 
     @staticmethod
-    def generate_answer(question, context, mode='syllabus', history=None, syllabus_context=None, custom_sys_prompt=None, user_preferred_name=None, course=None, semester=None, subject=None):
+    def _build_answer_messages(question, context, mode='syllabus', history=None, syllabus_context=None, custom_sys_prompt=None, user_preferred_name=None, course=None, semester=None, subject=None):
+        """Return (direct_answer, None) for deterministic syllabus replies, else (None, chat messages)"""
         # Clean/normalize question terms deterministically for syllabus queries
         if mode == 'syllabus' and syllabus_context:
             question = AIService.normalize_syllabus_question(question, syllabus_context)
@@ -306,7 +473,7 @@ class AIService:
                         else:
                             out_parts.append("*No topics listed.*")
                         out_parts.append("")
-                    return "\n".join(out_parts)
+                    return "\n".join(out_parts), None
                 
                 # Check for unit-specific request (e.g. from normalize_syllabus_question)
                 match = re.search(r"^Provide the topics for '(.*)' as listed in the syllabus grounding\.$", question)
@@ -317,9 +484,9 @@ class AIService:
                             topics = unit.get("topics", [])
                             if topics:
                                 topics_list_str = "\n".join([f"* {t}" for t in topics])
-                                return f"Here are the topics listed under **{unit.get('title')}**:\n\n{topics_list_str}"
+                                return f"Here are the topics listed under **{unit.get('title')}**:\n\n{topics_list_str}", None
                             else:
-                                return f"There are no specific topics listed under **{unit.get('title')}**."
+                                return f"There are no specific topics listed under **{unit.get('title')}**.", None
             except Exception as e:
                 logging.warning(f"Deterministic local syllabus parsing failed: {e}")
 
@@ -394,59 +561,98 @@ class AIService:
             "role": "user", 
             "content": user_content
         })
+        return None, messages
 
+    @staticmethod
+    def _complete_answer(messages):
         # 1. Try Hugging Face (Primary)
         credits_depleted = False
         try:
-            token = current_app.config.get("HUGGINGFACE_API_TOKEN") if current_app else Config.HUGGINGFACE_API_TOKEN
-            
-            hf_model = current_app.config.get("HF_LLM_MODEL") if current_app else Config.HF_LLM_MODEL
-            hf_fallbacks = [
-                hf_model,
-                "Qwen/Qwen2.5-7B-Instruct",
-                "meta-llama/Llama-3.2-3B-Instruct",
-                "mistralai/Mistral-7B-Instruct-v0.3",
-                "Qwen/Qwen3-8B"
-            ]
-
-            for mdl in hf_fallbacks:
-                if not mdl: continue
-                try:
-                    out = AIService._chat_completion_with_fallback(
-                        messages=messages,
-                        model=mdl,
-                        token=token,
-                        max_tokens=1200,
-                        temperature=0.2,
-                        timeout=45
-                    )
-                    if out and len(out.strip()) > 0:
-                        return AIService.clean_response(out.strip())
-                except Exception as inner_ex:
-                    err_str = str(inner_ex).lower()
-                    if "402" in err_str or "payment required" in err_str or "credits" in err_str:
-                        credits_depleted = True
-                    logging.warning(f"Hugging Face generation fallback {mdl} failed: {inner_ex}")
-                    continue
+            token = _config("HUGGINGFACE_API_TOKEN")
+            models = _candidate_models(_config("HF_LLM_MODEL"), _ANSWER_FALLBACK_MODELS)
+            out, credits_depleted = AIService._generate_with_fallbacks(
+                messages, models, token, "Hugging Face generation",
+                max_tokens=1200, temperature=0.2, timeout=45
+            )
+            if out:
+                return AIService.clean_response(out)
         except Exception as e:
-            err_str = str(e).lower()
-            if "402" in err_str or "payment required" in err_str or "credits" in err_str:
-                credits_depleted = True
+            credits_depleted = _is_credit_error(e)
             logging.error(f"Hugging Face generation failed: {e}")
 
         if credits_depleted:
-            return "Your Hugging Face API monthly included credits are depleted. Please purchase pre-paid credits, upgrade your Hugging Face account to Pro, or configure another API token in your settings."
+            return CREDITS_DEPLETED_MESSAGE
         return "The AI service is currently experiencing high load or is temporarily unavailable. Please try again in a moment."
 
+    @staticmethod
+    def generate_answer(question, context, mode='syllabus', history=None, syllabus_context=None, custom_sys_prompt=None, user_preferred_name=None, course=None, semester=None, subject=None):
+        direct_answer, messages = AIService._build_answer_messages(
+            question, context, mode=mode, history=history, syllabus_context=syllabus_context,
+            custom_sys_prompt=custom_sys_prompt, user_preferred_name=user_preferred_name,
+            course=course, semester=semester, subject=subject
+        )
+        if direct_answer is not None:
+            return direct_answer
+        return AIService._complete_answer(messages)
+
+    @staticmethod
+    def generate_answer_stream(question, context, mode='syllabus', history=None, syllabus_context=None, custom_sys_prompt=None, user_preferred_name=None, course=None, semester=None, subject=None):
+        """
+        Same as generate_answer, but yields the answer incrementally as the LLM decodes it.
+        Deterministic syllabus answers and the non-streaming fallback chain are yielded whole.
+        Raises if the stream breaks after part of the answer was yielded.
+        """
+        direct_answer, messages = AIService._build_answer_messages(
+            question, context, mode=mode, history=history, syllabus_context=syllabus_context,
+            custom_sys_prompt=custom_sys_prompt, user_preferred_name=user_preferred_name,
+            course=course, semester=semester, subject=subject
+        )
+        if direct_answer is not None:
+            yield direct_answer
+            return
+
+        # Stream from the first model not in cooldown, same order as the blocking fallback chain
+        model = _candidate_models(_config("HF_LLM_MODEL"), _ANSWER_FALLBACK_MODELS)[0]
+        client = _inference_client(_config("HUGGINGFACE_API_TOKEN"), 45)
+        emitted = False
+        head = ""
+        try:
+            for event in client.chat_completion(messages=messages, model=model, max_tokens=1200, temperature=0.2, stream=True):
+                delta = event.choices[0].delta.content if event.choices else None
+                if not delta:
+                    continue
+                if not emitted:
+                    # Buffer the opening so clean_response can still strip "Answer:"-style prefixes
+                    head += delta
+                    if len(head) < 120:
+                        continue
+                    cleaned = AIService.clean_response(head)
+                    delta = cleaned + head[len(head.rstrip()):] if cleaned else ""
+                    emitted = True
+                if delta:
+                    yield delta
+            if not emitted and head.strip():
+                yield AIService.clean_response(head)
+                emitted = True
+            if emitted:
+                return
+        except Exception as e:
+            logging.warning(f"Hugging Face streaming generation failed for {model}: {e}")
+            if _is_model_unavailable(e):
+                _model_failed_at[model] = time.monotonic()
+            if emitted:
+                # Part of the answer is already on the wire; it cannot be retried transparently,
+                # and a truncated answer must not be mistaken for a complete one
+                raise
+
+        # Streaming unavailable: fall back to the blocking fallback chain
+        yield AIService._complete_answer(messages)
+
     @staticmethod
     def generate_answer_from_website(question, context, source_url="", history=None, user_preferred_name=None, course=None, semester=None, subject=None):
         """Answer only from the given website page content. Do not use external knowledge."""
         try:
-            try:
-                token = current_app.config.get("HUGGINGFACE_API_TOKEN") if current_app else None
-            except Exception:
-                token = None
-            client = InferenceClient(token=token or Config.HUGGINGFACE_API_TOKEN, timeout=45)
+            token = _config("HUGGINGFACE_API_TOKEN")
             
             # 1. System Prompt
             import datetime
@@ -480,70 +686,16 @@ class AIService:
             context_str = context if context.strip() else "[NO WEBPAGE CONTENT FOUND. YOU MUST STATE THE INFORMATION IS NOT ON THE PAGE.]"
             messages.append({"role": "user", "content": f"Webpage (Source: {source_url}):\n{context_str}\n\nUser Question/Instruction: {question}"})
 
-            try:
-                llm_model = current_app.config.get("HF_LLM_MODEL") if current_app else None
-            except Exception:
-                llm_model = None
-            primary = llm_model or Config.HF_LLM_MODEL
-            fallbacks = []
-            if primary:
-                fallbacks.append(primary)
-            
-            robust_models = [
-                "Qwen/Qwen2.5-7B-Instruct",
-                "meta-llama/Llama-3.2-3B-Instruct",
-                "mistralai/Mistral-7B-Instruct-v0.3",
-                "Qwen/Qwen3-8B"
-            ]
-            for m in robust_models:
-                if m not in fallbacks:
-                    fallbacks.append(m)
-            
-            credits_depleted = False
-            for mdl in fallbacks:
-                if not mdl:
-                    continue
-                try:
-                    out = AIService._chat_completion_with_fallback(
-                        messages=messages,
-                        model=mdl,
-                        token=token or Config.HUGGINGFACE_API_TOKEN,
-                        max_tokens=1300,
-                        temperature=0.2,
-                        timeout=45
-                    )
-                    if out and len(out.strip()) > 0:
-                        return AIService.clean_response(out.strip())
-                except Exception as e:
-                    err_str = str(e).lower()
-                    if "402" in err_str or "payment required" in err_str or "credits" in err_str:
-                        credits_depleted = True
-                    logging.warning(f"Website chat completion failed with {mdl}: {e}")
-                    # Fallback to legacy text generation
-                    try:
-                        client_legacy = InferenceClient(token=token or Config.HUGGINGFACE_API_TOKEN, timeout=45)
-                        prompt_legacy = (
-                            "Instruction: Analyze the following webpage content and answer the question.\n"
-                            f"Webpage Content:\n{context}\n\n"
-                            f"Question: {question}\n\n"
-                            "Answer:"
-                        )
-                        out = client_legacy.text_generation(
-                            prompt_legacy,
-                            model=mdl,
-                            max_new_tokens=1200,
-                            temperature=0.2,
-                        )
-                        if out and len(out.strip()) > 0:
-                            return AIService.clean_response(out.strip())
-                    except Exception as e2:
-                        err_str2 = str(e2).lower()
-                        if "402" in err_str2 or "payment required" in err_str2 or "credits" in err_str2:
-                            credits_depleted = True
-                        continue
-                        
+            # One prompt, chat models only: the old per-model text_generation retry doubled worst-case latency
+            models = _candidate_models(_config("HF_LLM_MODEL"), _ANSWER_FALLBACK_MODELS)
+            out, credits_depleted = AIService._generate_with_fallbacks(
+                messages, models, token, "Website chat completion",
+                max_tokens=1300, temperature=0.2, timeout=45
+            )
+            if out:
+                return AIService.clean_response(out)
             if credits_depleted:
-                return "Your Hugging Face API monthly included credits are depleted. Please purchase pre-paid credits, upgrade your Hugging Face account to Pro, or configure another API token in your settings."
+                return CREDITS_DEPLETED_MESSAGE
             logging.error("All Hugging Face fallback models failed for website content.")
             return "This information is not found on the page."
         except Exception as e:
@@ -554,59 +706,26 @@ class AIService:
         t = (text or "").strip().lower().strip('.').strip('!').strip('?').strip()
         if not t: return False
         
-        # Expanded greetings and common conversational acknowledgments
-        smalltalk_phrases = [
-            "hi", "hello", "hey", "thanks", "thank you", "good morning", "good evening", "good afternoon",
-            "nice", "okay", "ok", "oka", "cool", "great", "excellent", "awesome", "perfect",
-            "wow", "i see", "understood", "got it", "fine", "yes", "no", "bye", "goodbye",
-            "hii", "hiii", "hiiii", "heyy", "heyyy", "helloo", "hellooo"
-        ]
-        
-        # Exact matches or matches in our extended list
-        if t in smalltalk_phrases:
+        # Exact matches of greetings and common conversational acknowledgments
+        if t in _SMALLTALK_PHRASES:
             return True
             
         # Handle simple greetings with punctuation
-        cleaned_t = "".join(filter(str.isalnum, t))
-        if cleaned_t in ["hi", "hello", "hey", "hii", "hiii", "heyy", "heyyy", "yo", "sup", "greetings"]:
+        if _NON_ALNUM_RE.sub('', t) in _GREETING_WORDS:
             return True
 
-        # Handle repeated characters (e.g., "heyyyyy")
-        import re
-        words = t.split()
-        if len(words) == 1:
-            norm_w = re.sub(r'(.)\1+', r'\1', words[0])
-            # Common greet roots
-            if norm_w in ["hi", "he", "hey", "helo", "hello", "thank"]:
-                return True
-        
-        # If it's a very short message (1-2 words) that matches any of these, it's smalltalk
-        if len(words) <= 2:
-            if any(t == p or t.startswith(p + " ") or t.endswith(" " + p) for p in smalltalk_phrases):
-                # But only if it doesn't look like a real search (e.g., 'fine art' is NOT smalltalk)
-                # Short phrases like "who are you" should NOT be smalltalk (they are identity intent)
-                if t in ["how are you", "what's up", "whats up", "how r u"]:
-                    return True
-                if len(words) == 1 or t in ["i see", "got it", "thank you", "good morning", "good evening", "good afternoon"]:
-                    return True
-        
-        return False
+        # Handle repeated characters (e.g., "heyyyyy"); short phrases like "fine art" or
+        # "who are you" deliberately fall through (they are real searches / identity intent)
+        return _STRETCHED_GREETING_RE.fullmatch(t) is not None
 
     @staticmethod
     def generate_smalltalk(text: str, mode='syllabus', user_preferred_name=None, course=None, semester=None, subject=None):
         credits_depleted = False
         # Try Hugging Face first (Primary with robust fallbacks)
         try:
-            token = current_app.config.get("HUGGINGFACE_API_TOKEN") if current_app else Config.HUGGINGFACE_API_TOKEN
+            token = _config("HUGGINGFACE_API_TOKEN")
             
-            hf_model = current_app.config.get("HF_SMALLTALK_MODEL") if current_app else Config.HF_SMALLTALK_MODEL
-            fallbacks = [
-                hf_model,
-                "Qwen/Qwen3-4B-Instruct-2507",
-                "google/gemma-2-2b-it",
-                "Qwen/Qwen2.5-7B-Instruct",
-                "meta-llama/Llama-3.2-1B-Instruct"
-            ]
+            models = _candidate_models(_config("HF_SMALLTALK_MODEL"), _SMALLTALK_FALLBACK_MODELS)
             
             # If in general mode, we do NOT include coursework details
             has_coursework = (mode == 'syllabus' or mode == 'studies') and course and semester
@@ -621,36 +740,22 @@ class AIService:
                 f"IMPORTANT: You MUST start your response by greeting the user by their name '{user_preferred_name}' (e.g. 'Hello {user_preferred_name}!')" if user_preferred_name else ""
             )
 
-            for mdl in fallbacks:
-                if not mdl: continue
-                try:
-                    out = AIService._chat_completion_with_fallback(
-                        messages=[
-                            {"role": "system", "content": system_content},
-                            {"role": "user", "content": text}
-                        ],
-                        model=mdl,
-                        token=token,
-                        max_tokens=64,
-                        temperature=0.7,
-                        timeout=8
-                    )
-                    if out and len(out.strip()) > 0:
-                        return AIService.clean_response(out.strip())
-                except Exception as inner_ex:
-                    err_str = str(inner_ex).lower()
-                    if "402" in err_str or "payment required" in err_str or "credits" in err_str:
-                        credits_depleted = True
-                    logging.warning(f"Hugging Face smalltalk fallback {mdl} failed: {inner_ex}")
-                    continue
+            out, credits_depleted = AIService._generate_with_fallbacks(
+                [
+                    {"role": "system", "content": system_content},
+                    {"role": "user", "content": text}
+                ],
+                models, token, "Hugging Face smalltalk",
+                max_tokens=64, temperature=0.7, timeout=8
+            )
+            if out:
+                return AIService.clean_response(out)
         except Exception as e:
-            err_str = str(e).lower()
-            if "402" in err_str or "payment required" in err_str or "credits" in err_str:
-                credits_depleted = True
+            credits_depleted = _is_credit_error(e)
             logging.warning(f"Hugging Face smalltalk failed: {e}")
         
         if credits_depleted:
-            return "Your Hugging Face API monthly included credits are depleted. Please purchase pre-paid credits, upgrade your Hugging Face account to Pro, or configure another API token in your settings."
+            return CREDITS_DEPLETED_MESSAGE
         
         # Final hardcoded fallback
         name_part = f" {user_preferred_name}" if user_preferred_name else ""
@@ -673,24 +778,15 @@ class AIService:
     @staticmethod
     def generate_image_caption(image_bytes: bytes):
         """Generate a caption for an image using a VLM via Hugging Face API"""
-        try:
-            token = current_app.config.get("HUGGINGFACE_API_TOKEN") if current_app else None
-        except Exception:
-            token = None
-            
         # Ensure we have a token
-        token = token or Config.HUGGINGFACE_API_TOKEN
+        token = _config("HUGGINGFACE_API_TOKEN")
         if not token:
             return " [Image: No caption available - API token missing] "
             
-        client = InferenceClient(token=token, timeout=10)
+        client = _inference_client(token, 10)
         
         try:
-            try:
-                model = current_app.config.get("HF_IMAGE_CAPTION_MODEL") if current_app else None
-            except Exception:
-                model = None
-            model = model or Config.HF_IMAGE_CAPTION_MODEL
+            model = _config("HF_IMAGE_CAPTION_MODEL")
             
             # The client.image_to_text method is the standard for captioning
             # It accepts bytes directly or PIL images
@@ -962,10 +1058,9 @@ class AIService:
                 "If the text is not a syllabus or contains no curriculum data, return {\"units\": []}."
             )
             
-            token = current_app.config.get("HUGGINGFACE_API_TOKEN") if current_app else Config.HUGGINGFACE_API_TOKEN
-            client = InferenceClient(token=token, timeout=90)
+            token = _config("HUGGINGFACE_API_TOKEN")
             
-            primary_model = current_app.config.get("HF_SYLLABUS_MODEL") if current_app else Config.HF_SYLLABUS_MODEL
+            primary_model = _config("HF_SYLLABUS_MODEL")
             fallbacks = [
                 primary_model,
                 "Qwen/Qwen3-8B"
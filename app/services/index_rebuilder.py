@@ -2,8 +2,58 @@ from app.services.vector_store import VectorStore
 from app.models import DocumentChunk
 from app import db
 from app.utils.background_tasks import TaskTracker
+from sqlalchemy import select, func
 import logging
 
+# Chunks fetched per keyset page, and vectors per bulk insert/commit
+CHUNK_PAGE_SIZE = 1000
+BULK_BATCH_SIZE = 1000
+
+def _iter_chunk_rows(page_size=CHUNK_PAGE_SIZE):
+    """
+    Yield (id, document_id, chunk_text) for every chunk in id order, one keyset page at a time.
+    Each page is a short query on db.session, so it survives the commits bulk_add makes between
+    pages and never holds one snapshot open for the whole rebuild (as a server-side cursor would).
+    """
+    last_id = 0
+    while True:
+        page = db.session.execute(
+            select(DocumentChunk.id, DocumentChunk.document_id, DocumentChunk.chunk_text)
+            .where(DocumentChunk.id > last_id)
+            .order_by(DocumentChunk.id)
+            .limit(page_size)
+        ).all()
+        if not page:
+            return
+        yield from page
+        last_id = page[-1][0]
+
+def _embed_chunk_batch(vector_store, texts, metas, previous_generation):
+    """
+    Vectors for one batch of chunks, reusing the stored vector for any chunk whose text is
+    unchanged since the previous build and only calling the embedding API for the rest.
+    Returns (embeddings, reused_count).
+    """
+    stored = vector_store.get_stored_embeddings([m['chunk_id'] for m in metas], previous_generation)
+    embeddings = [None] * len(texts)
+    missing = []
+    for i, (t, m) in enumerate(zip(texts, metas)):
+        hit = stored.get(str(m['chunk_id']))
+        if hit and hit[0] == t:
+            embeddings[i] = hit[1]
+        else:
+            missing.append(i)
+
+    if missing:
+        from app.services.ai_service import AIService
+        fresh = AIService.get_embeddings([texts[i] for i in missing])
+        if fresh is None or len(fresh) != len(missing):
+            raise RuntimeError("Failed to generate embeddings for rebuild batch")
+        for i, emb in zip(missing, fresh):
+            embeddings[i] = emb
+
+    return embeddings, len(texts) - len(missing)
+
 def rebuild_index_from_db():
     """Rebuild the vector index from database documents on app startup"""
     print("[INFO] Rebuilding vector index from database...")
@@ -12,12 +62,12 @@ def rebuild_index_from_db():
     task_name = "rebuild"
     TaskTracker.update_progress(task_name, 0, 100, "Initializing...")
 
+    generation = None
     try:
-        # Query all document chunks from the database
-        total_chunks = DocumentChunk.query.count()
-        chunks = DocumentChunk.query.all()
+        # Count document chunks; the chunks themselves are paged in below rather than loaded at once
+        total_chunks = db.session.query(func.count(DocumentChunk.id)).scalar()
 
-        if not chunks:
+        if not total_chunks:
             print("[WARN] No chunks found in DB")
             logging.info("No document chunks found in database")
             TaskTracker.complete_task(task_name, "No data to rebuild")
@@ -35,7 +85,9 @@ def rebuild_index_from_db():
             'subject': d.subject.strip().upper() if d.subject else None
         } for d in docs}
 
-        system_chunks_count = sum(1 for c in chunks if doc_map.get(c.document_id, {}).get('doc_type') == 'system_info')
+        system_chunks_count = db.session.query(func.count(DocumentChunk.id)).join(
+            Document, Document.id == DocumentChunk.document_id
+        ).filter(Document.doc_type == 'system_info').scalar()
         syllabus_chunks_count = total_chunks - system_chunks_count
         logging.info(f"Re-vectoring: {syllabus_chunks_count} syllabus/supporting chunks and {system_chunks_count} system intelligence chunks found.")
 
@@ -43,44 +95,55 @@ def rebuild_index_from_db():
         
         # 3. Get the singleton vector store instance
         vector_store = VectorStore.get_instance()
-        vector_store.clear()
-        db.session.commit() # Clear before adding new ones
+        # Keep the current vectors until the new set is written: they are reused for unchanged
+        # chunks and keep serving searches. New rows go into a pending generation that
+        # match_documents ignores until swap_generation flips the active pointer at the end
+        cutoff_id = vector_store.max_vector_id()
+        previous_generation, generation = vector_store.begin_generation()
+        db.session.commit()
 
         BATCH_SIZE = 64
-        current_batch_texts = []
-        current_batch_metas = []
         total_processed = 0
-        
-        # Iterate over the already-loaded chunks list
-        # We avoid yield_per because db.session.commit() inside add_texts will kill server-side cursors
-        for c in chunks:
-            current_batch_texts.append(c.chunk_text)
-            
-            doc_info = doc_map.get(c.document_id, {'doc_type': 'syllabus', 'filename': None, 'course': None, 'semester': None, 'subject': None})
-            current_batch_metas.append({
-                'text': c.chunk_text,
-                'doc_id': c.document_id,
-                'chunk_id': c.id,
-                'doc_type': doc_info['doc_type'],
-                'filename': doc_info['filename'],
-                'course': doc_info['course'],
-                'semester': doc_info['semester'],
-                'subject': doc_info['subject']
-            })
-            
-            if len(current_batch_texts) >= BATCH_SIZE:
-                vector_store.add_texts(current_batch_texts, current_batch_metas)
-                db.session.commit()
-                total_processed += len(current_batch_texts)
-                TaskTracker.update_progress(task_name, total_processed, total_chunks, "Re-indexing vectors...")
-                current_batch_texts = []
-                current_batch_metas = []
-        
-        # Final batch
-        if current_batch_texts:
-            vector_store.add_texts(current_batch_texts, current_batch_metas)
-            db.session.commit()
-            total_processed += len(current_batch_texts)
+        total_reused = 0
+
+        def chunk_vectors(rows):
+            """Yield (embedding, metadata) per chunk, embedding BATCH_SIZE chunks at a time"""
+            nonlocal total_processed, total_reused
+            batch_texts = []
+            batch_metas = []
+            for chunk_id, document_id, chunk_text in rows:
+                batch_texts.append(chunk_text)
+
+                doc_info = doc_map.get(document_id, {'doc_type': 'syllabus', 'filename': None, 'course': None, 'semester': None, 'subject': None})
+                batch_metas.append({
+                    'text': chunk_text,
+                    'doc_id': document_id,
+                    'chunk_id': chunk_id,
+                    'doc_type': doc_info['doc_type'],
+                    'filename': doc_info['filename'],
+                    'course': doc_info['course'],
+                    'semester': doc_info['semester'],
+                    'subject': doc_info['subject']
+                })
+
+                if len(batch_texts) >= BATCH_SIZE:
+                    embeddings, reused = _embed_chunk_batch(vector_store, batch_texts, batch_metas, previous_generation)
+                    yield from zip(embeddings, batch_metas)
+                    total_reused += reused
+                    total_processed += len(batch_texts)
+                    TaskTracker.update_progress(task_name, total_processed, total_chunks, "Re-indexing vectors...")
+                    batch_texts = []
+                    batch_metas = []
+
+            # Final batch
+            if batch_texts:
+                embeddings, reused = _embed_chunk_batch(vector_store, batch_texts, batch_metas, previous_generation)
+                yield from zip(embeddings, batch_metas)
+                total_reused += reused
+                total_processed += len(batch_texts)
+
+        # Chunks are paged in by id, so memory stays flat however large the table is
+        vector_store.bulk_add(chunk_vectors(_iter_chunk_rows()), batch=BULK_BATCH_SIZE, generation=generation)
         
         # 4. Re-generate Intelligence Grounding (Syllabus Unit Summaries)
         # These are virtual vectors extracted from structure_json
@@ -114,7 +177,7 @@ def rebuild_index_from_db():
                             })
                             
                             if len(unit_texts) >= BATCH_SIZE:
-                                vector_store.add_texts(unit_texts, unit_metas)
+                                vector_store.add_texts(unit_texts, unit_metas, generation=generation)
                                 db.session.commit()
                                 unit_texts = []
                                 unit_metas = []
@@ -122,13 +185,26 @@ def rebuild_index_from_db():
                     logging.error(f"Failed to parse structure for doc {d.id}: {je}")
         
         if unit_texts:
-            vector_store.add_texts(unit_texts, unit_metas)
+            vector_store.add_texts(unit_texts, unit_metas, generation=generation)
             db.session.commit()
 
+        # Swap: serve the new generation and drop the previous one in a single transaction
+        vector_store.swap_generation(generation, previous_generation, cutoff_id)
+        db.session.commit()
+        logging.info(f"Reused {total_reused} stored vectors; embedded {total_processed - total_reused} changed chunks.")
+
         TaskTracker.complete_task(task_name, f"Successfully rebuilt {total_processed} chunks (including {system_chunks_count} system intelligence) and grounded syllabus maps")
         logging.info(f"Successfully rebuilt vector index. {total_processed} chunks processed (including {system_chunks_count} system intelligence).")
         
     except Exception as e:
         logging.error(f"Error rebuilding vector index from database: {e}", exc_info=True)
+        if generation is not None:
+            # Keep serving the previous generation: drop only the rows this rebuild wrote
+            try:
+                db.session.rollback()
+                VectorStore.get_instance().discard_generation(generation)
+                db.session.commit()
+            except Exception as ce:
+                logging.error(f"Failed to discard partial rebuild: {ce}")
         TaskTracker.complete_task(task_name, f"Error: {str(e)}")
-        raise
\ No newline at end of file
+        raise
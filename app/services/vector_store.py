@@ -1,23 +1,40 @@
 import numpy as np
 import logging
+import orjson
+import threading
+from flask import current_app, has_app_context
+from config import Config
+
+def _dumps(obj):
+    """Compact JSON text for SQL parameters (orjson returns bytes)"""
+    return orjson.dumps(obj).decode()
+
+_loads = orjson.loads
 
 class VectorStore:
+    """
+    Process-wide singleton. Use VectorStore.get_instance(); direct VectorStore() calls
+    are deprecated (they return the same instance, but hide that it is shared).
+    """
     _instance = None
+    _lock = threading.Lock()
     
     def __new__(cls):
+        # Double-checked locking: the background warm-up/rebuild threads and request
+        # threads may race here on first use
         if cls._instance is None:
-            cls._instance = super(VectorStore, cls).__new__(cls)
-            # Try to get dimension from config, default to 384 for MiniLM
-            cls._instance.dimension = 384 
-            cls._instance._stats_cache = None
-            cls._instance._stats_cache_time = 0
-            cls._instance.STATS_CACHE_TTL = 60 # 1 minute
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super(VectorStore, cls).__new__(cls)
+                    # Try to get dimension from config, default to 384 for MiniLM
+                    instance.dimension = 384 
+                    instance._stats_cache = None
+                    instance._stats_cache_time = 0
+                    instance.STATS_CACHE_TTL = 60 # 1 minute
+                    # Publish only once fully initialized
+                    cls._instance = instance
         return cls._instance
 
-    @staticmethod
-    def get_instance():
-        return VectorStore()
-
     def initialize_index(self, dimension=384):
         """
         In Supabase, the 'index' is managed by the database table.
@@ -26,48 +43,80 @@ class VectorStore:
         self.dimension = dimension
         logging.info(f"Supabase VectorStore initialized with dimension {dimension}")
 
-    def add_documents(self, embeddings, chunks_metadata):
+    @staticmethod
+    def _normalize(vectors):
+        """L2-normalize float32 rows in place so the inner product equals cosine similarity"""
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors /= norms
+        return vectors
+
+    def _as_matrix(self, embeddings):
+        """
+        Pack embeddings into one C-contiguous float32 (n, dimension) matrix.
+        Arrays are cast/copied once (the copy is normalized in place, never the caller's data);
+        lists are filled row by row into a preallocated buffer instead of list -> array -> astype.
+        """
+        if isinstance(embeddings, np.ndarray):
+            vectors = np.array(embeddings, dtype=np.float32, order='C')
+            if vectors.ndim != 2 or vectors.shape[1] != self.dimension:
+                raise ValueError(f"Expected embeddings of shape (n, {self.dimension}), got {vectors.shape}")
+            return vectors
+
+        vectors = np.empty((len(embeddings), self.dimension), dtype=np.float32)
+        for i, emb in enumerate(embeddings):
+            vectors[i] = emb
+        return vectors
+
+    @staticmethod
+    def _lift_statement_timeout(session):
+        """
+        Bulk deletes on a large embeddings table can outlast the pool's default statement_timeout.
+        SET LOCAL only lasts until the caller's commit/rollback, like the startup migrations.
+        """
+        from sqlalchemy import text
+        session.execute(text("SET LOCAL statement_timeout = 0"))
+
+    def add_documents(self, embeddings, chunks_metadata, generation=None):
         """
-        embeddings: list of floats or numpy array
+        embeddings: list of float lists or a 2-D numpy array
         chunks_metadata: list of dicts containing text and other info
+        generation: rebuild generation to write into (default: the one currently served)
         """
-        if not embeddings or len(embeddings) == 0:
+        if embeddings is None or len(embeddings) == 0:
             return
 
-        # 🔥 Normalize to list of floats for Supabase
+        # 🔥 Unit-normalize once at insert time so search can rank by plain inner product
+        return self._insert_rows(self._normalize(self._as_matrix(embeddings)), chunks_metadata, generation)
+
+    def _insert_rows(self, vectors, chunks_metadata, generation=None):
+        """Insert already-normalized float32 rows with their metadata as multi-row INSERTs"""
         records = []
-        for i, emb in enumerate(embeddings):
-            # Ensure embedding is a list of floats
-            if hasattr(emb, 'tolist'):
-                vector = emb.tolist()
-            else:
-                vector = list(emb)
-            
-            metadata = chunks_metadata[i].copy()
+        for i, emb in enumerate(vectors):
+            # Keep the JSONB compact: null-valued keys carry no information (readers use .get())
+            metadata = {key: value for key, value in chunks_metadata[i].items() if value is not None}
             content = metadata.pop('text', '')
             
-            records.append({
+            record = {
                 'content': content,
-                'metadata': metadata,
-                'embedding': vector
-            })
+                'metadata': _dumps(metadata),
+                'embedding': _dumps(emb.tolist())
+            }
+            # Omitted, the column default (active_vector_generation()) applies
+            if generation is not None:
+                record['generation'] = generation
+            records.append(record)
         
         try:
             from app import db
-            from sqlalchemy import text
-            import json
+            from sqlalchemy import insert, table, column
             
-            sql = text("""
-                INSERT INTO embeddings (content, metadata, embedding) 
-                VALUES (:content, :metadata, :embedding)
-            """)
+            embeddings_table = table('embeddings', column('content'), column('metadata'), column('embedding'), column('generation'))
             
-            for record in records:
-                db.session.execute(sql, {
-                    'content': record['content'],
-                    'metadata': json.dumps(record['metadata']),
-                    'embedding': str(record['embedding'])
-                })
+            # An insert() construct with a list of parameter sets uses SQLAlchemy's "insertmanyvalues"
+            # batching: one INSERT ... VALUES (...), (...) per 1000 rows. A text() statement would
+            # run as psycopg2 executemany, which is still one round-trip per row.
+            db.session.execute(insert(embeddings_table), records)
             
             logging.info(f"Successfully added {len(records)} documents to Supabase pgvector via SQLAlchemy")
             self._stats_cache = None
@@ -76,7 +125,33 @@ class VectorStore:
             logging.error(f"Error adding documents to Supabase via DB: {e}")
             raise
 
-    def add_texts(self, texts, metadata_list=None):
+    def bulk_add(self, rows, batch=1000, generation=None):
+        """
+        Stream (embedding, metadata) pairs into the store, committing every `batch` rows.
+        Vectors are packed into one preallocated (batch, dimension) float32 buffer that is
+        reused for every flush, so memory stays flat no matter how many rows flow through.
+        Returns the number of rows inserted.
+        """
+        from app import db
+
+        buf = np.empty((batch, self.dimension), dtype=np.float32)
+        metas = []
+        total = 0
+        for emb, meta in rows:
+            buf[len(metas)] = emb
+            metas.append(meta)
+            if len(metas) == batch:
+                self._insert_rows(self._normalize(buf), metas, generation)
+                db.session.commit()
+                total += batch
+                metas = []
+        if metas:
+            self._insert_rows(self._normalize(buf[:len(metas)]), metas, generation)
+            db.session.commit()
+            total += len(metas)
+        return total
+
+    def add_texts(self, texts, metadata_list=None, generation=None):
         """
         Add raw texts to the vector store by converting them to embeddings
         """
@@ -102,19 +177,29 @@ class VectorStore:
                 if 'text' not in meta:
                     meta['text'] = texts[i]
         
-        self.add_documents(embeddings, metadata_list)
+        self.add_documents(embeddings, metadata_list, generation)
 
     def remove_document(self, doc_id):
         """
         Remove documents by their document_id from the metadata JSONB column
         """
+        self.remove_documents([doc_id])
+
+    def remove_documents(self, doc_ids):
+        """
+        Remove the vectors of several documents in a single DELETE.
+        Served by the expression indexes on metadata->>'doc_id' / 'document_id'.
+        """
+        if not doc_ids:
+            return
         try:
             from app import db
             from sqlalchemy import text
-            sql = text("DELETE FROM embeddings WHERE metadata->>'doc_id' = :doc_id OR metadata->>'document_id' = :doc_id")
-            db.session.execute(sql, {'doc_id': str(doc_id)})
+            sql = text("DELETE FROM embeddings WHERE metadata->>'doc_id' = ANY(:doc_ids) OR metadata->>'document_id' = ANY(:doc_ids)")
+            self._lift_statement_timeout(db.session)
+            db.session.execute(sql, {'doc_ids': [str(d) for d in doc_ids]})
             self._stats_cache = None
-            logging.info(f"Removed documents with doc_id {doc_id} from Supabase via SQLAlchemy")
+            logging.info(f"Removed documents with doc_ids {list(doc_ids)} from Supabase via SQLAlchemy")
         except Exception as e:
             logging.error(f"Error removing document from Supabase DB: {e}")
             raise
@@ -139,49 +224,130 @@ class VectorStore:
         Search for similar documents using match_documents RPC via SQLAlchemy with optional filtering
         """
         try:
-            # Ensure query_vector is a list
-            if hasattr(query_vector, 'tolist'):
-                vector = query_vector.tolist()
-            else:
-                vector = list(query_vector)
+            # Normalize the query the same way stored vectors are normalized
+            vector = self._normalize(np.array(query_vector, dtype=np.float32)).tolist()
 
             from app import db
             from sqlalchemy import text
-            import json
+
+            # Widen the HNSW candidate list for this transaction so filtered queries still fill k results
+            ef_search = current_app.config.get('VECTOR_HNSW_EF_SEARCH') if has_app_context() else None
+            ef_search = max(int(ef_search or Config.VECTOR_HNSW_EF_SEARCH), k)
+            db.session.execute(text(f"SET LOCAL hnsw.ef_search = {ef_search}"))
 
             # Match documents via raw SQL execute calling the database function
             sql = text("""
-                SELECT id, content, metadata, similarity 
+                SELECT content, metadata, 1 - similarity AS distance
                 FROM match_documents(:query_embedding, :match_threshold, :match_count, :filter)
             """)
 
             params = {
-                'query_embedding': str(vector),
+                'query_embedding': _dumps(vector),
                 'match_threshold': 0.1,
                 'match_count': k,
-                'filter': json.dumps(filter) if filter else '{}'
+                'filter': _dumps(filter) if filter else '{}'
             }
 
             db_res = db.session.execute(sql, params).fetchall()
 
+            # The driver decodes JSONB into a fresh dict per row, so extend it in place
+            # rather than copying every result
             results = []
-            for row in db_res:
-                meta = row[2]
-                if isinstance(meta, str):
+            for content, meta, distance in db_res:
+                if not isinstance(meta, dict):
                     try:
-                        meta = json.loads(meta)
+                        meta = _loads(meta) if meta else {}
                     except Exception:
                         meta = {}
-                res = meta.copy() if meta else {}
-                res['text'] = row[1] or ''
-                res['distance'] = 1.0 - (row[3] or 0)
-                results.append(res)
+                meta['text'] = content or ''
+                meta['distance'] = 1.0 if distance is None else float(distance)
+                results.append(meta)
 
             return results
         except Exception as e:
             logging.error(f"Error searching via SQLAlchemy: {e}")
             return []
 
+    def get_stored_embeddings(self, chunk_ids, generation):
+        """
+        Existing vectors of `generation` for the given chunk ids, keyed by chunk_id as a string:
+        {chunk_id: (content, vector)}. Lets a rebuild skip re-embedding unchanged chunks.
+        """
+        ids = [str(c) for c in chunk_ids if c is not None]
+        if not ids:
+            return {}
+        from app import db
+        from sqlalchemy import text
+        sql = text("""
+            SELECT metadata->>'chunk_id', content, embedding::text FROM embeddings
+            WHERE metadata->>'chunk_id' = ANY(:chunk_ids) AND generation = :generation
+        """)
+        rows = db.session.execute(sql, {'chunk_ids': ids, 'generation': generation}).fetchall()
+        # pgvector's text form '[0.1,0.2,...]' is valid JSON
+        return {chunk_id: (content, _loads(embedding)) for chunk_id, content, embedding in rows}
+
+    def max_vector_id(self):
+        """Highest embeddings row id; rows above it were written after this call"""
+        from app import db
+        from sqlalchemy import text
+        return db.session.execute(text("SELECT coalesce(max(id), 0) FROM embeddings")).scalar() or 0
+
+    def begin_generation(self):
+        """
+        Reserve a new generation for a rebuild and return (active, new). Rows written with the new
+        generation stay invisible to match_documents until swap_generation. Leftovers of earlier
+        rebuilds that never finished are deleted. Callers commit.
+        """
+        from app import db
+        from sqlalchemy import text
+        active, generation = db.session.execute(text("""
+            UPDATE vector_generation SET pending = greatest(active, coalesce(pending, 0)) + 1
+            RETURNING active, pending
+        """)).one()
+        self._lift_statement_timeout(db.session)
+        db.session.execute(text("DELETE FROM embeddings WHERE generation <> :active"), {'active': active})
+        return active, generation
+
+    def swap_generation(self, generation, previous, max_id):
+        """
+        Serve `generation` instead of `previous` (callers commit; one transaction). The switch itself is
+        a one-row pointer update: rows of the new generation are never rewritten, so no index
+        (HNSW included) is touched. Vectors that uploads added under `previous` while the rebuild ran
+        (id > max_id) are carried over unless the rebuild already wrote the same content.
+        """
+        from app import db
+        from sqlalchemy import text
+        self._lift_statement_timeout(db.session)
+        promoted = db.session.execute(text("""
+            UPDATE vector_generation SET active = :generation, pending = NULL WHERE pending = :generation
+        """), {'generation': generation}).rowcount
+        if not promoted:
+            raise RuntimeError(f"Vector generation {generation} was superseded by a newer rebuild")
+        # generation is not indexed, so these few updates can be HOT
+        db.session.execute(text("""
+            UPDATE embeddings e SET generation = :generation
+            WHERE e.id > :max_id AND e.generation = :previous
+              AND NOT EXISTS (
+                  SELECT 1 FROM embeddings n
+                  WHERE n.generation = :generation
+                    AND n.metadata->>'doc_id' IS NOT DISTINCT FROM e.metadata->>'doc_id'
+                    AND n.content = e.content
+              )
+        """), {'generation': generation, 'previous': previous, 'max_id': max_id})
+        db.session.execute(text("DELETE FROM embeddings WHERE generation = :previous"), {'previous': previous})
+        self._stats_cache = None
+
+    def discard_generation(self, generation):
+        """Delete only the rows a failed rebuild wrote; the served generation is left untouched"""
+        from app import db
+        from sqlalchemy import text
+        self._lift_statement_timeout(db.session)
+        db.session.execute(text("UPDATE vector_generation SET pending = NULL WHERE pending = :generation"),
+                           {'generation': generation})
+        db.session.execute(text("DELETE FROM embeddings WHERE generation = :generation"),
+                           {'generation': generation})
+        self._stats_cache = None
+
     def clear(self):
         """
         Clear all records from the embeddings table
@@ -190,6 +356,7 @@ class VectorStore:
             from app import db
             from sqlalchemy import text
             sql = text("DELETE FROM embeddings WHERE content != '___NEVER_MATCH___'")
+            self._lift_statement_timeout(db.session)
             db.session.execute(sql)
             self._stats_cache = None
             logging.info("Cleared all embeddings from Supabase via SQLAlchemy")
@@ -197,6 +364,23 @@ class VectorStore:
             logging.error(f"Error clearing Supabase embeddings via DB: {e}")
             raise
 
+    def warming_up(self):
+        """
+        True while a startup rebuild is filling an empty store, as seen from any worker: the served
+        generation is empty and some session holds the rebuild advisory lock. A rebuild of a non-empty
+        store keeps serving the previous generation, so it never counts as warming up.
+        Costs one pg_locks lookup only while the (cached) stats report no vectors.
+        """
+        if self.get_stats()['total_vectors'] > 0:
+            return False
+        try:
+            from app import db, REBUILD_LOCK_ID
+            from app.utils.db_maintenance import advisory_lock_held
+            return advisory_lock_held(db.session, REBUILD_LOCK_ID)
+        except Exception as e:
+            logging.warning(f"Could not check vector store rebuild state: {e}")
+            return False
+
     def get_stats(self):
         import time
         now = time.time()
@@ -206,7 +390,8 @@ class VectorStore:
         try:
             from app import db
             from sqlalchemy import text
-            sql = text("SELECT count(id) FROM embeddings")
+            # Rows of an in-progress (or abandoned) rebuild aren't searchable, so don't count them
+            sql = text("SELECT count(id) FROM embeddings WHERE generation = active_vector_generation()")
             count = db.session.execute(sql).scalar() or 0
             stats = {
                 'total_vectors': count,
@@ -233,6 +418,7 @@ class VectorStore:
 
     @classmethod
     def get_instance(cls):
+        """Documented accessor for the shared vector store"""
         if cls._instance is None:
-            cls._instance = cls()
+            return cls()
         return cls._instance
@@ -0,0 +1,164 @@
+import logging
+import time
+from sqlalchemy import text
+
+DEFERRED_INDEX_LOCK_ID = 81734215
+
+# (index name, target definition) pairs for PostgreSQL.
+# Definitions omit the CREATE INDEX prefix so they can be built CONCURRENTLY.
+
+# Required by the chat retrieval path; built synchronously during startup
+CRITICAL_INDEXES = [
+    ('idx_document_chunks_document_id', 'public.document_chunks (document_id)'),
+]
+
+# Nice-to-have lookups; built by a background worker once the app is serving traffic
+DEFERRED_INDEXES = [
+    ('idx_document_chunks_comp_search', 'public.document_chunks (document_id, chunk_index)'),
+
+    # Indexes for user chat history and session management
+    ('idx_chat_messages_user_id', 'public.chat_messages (user_id)'),
+    ('idx_chat_messages_session_id', 'public.chat_messages (session_id)'),
+    ('idx_chat_messages_created_at', 'public.chat_messages (created_at DESC)'),
+    ('idx_chat_sessions_user_id', 'public.chat_sessions (user_id)'),
+    ('idx_chat_sessions_updated_at', 'public.chat_sessions (updated_at DESC)'),
+
+    # Indexes for dropdowns and filters
+    ('idx_filter_options_category', 'public.filter_options (category)'),
+    ('idx_filter_options_parent_id', 'public.filter_options (parent_id)'),
+
+    # Indexes for filtered document lookups
+    ('idx_documents_filters', 'public.documents (course, semester, subject)'),
+    ('idx_documents_uploaded_by', 'public.documents (uploaded_by)'),
+
+    # Expression indexes so vector deletes by document/chunk don't scan the whole embeddings table
+    ('idx_embeddings_doc_id', "public.embeddings ((metadata->>'doc_id'))"),
+    ('idx_embeddings_document_id', "public.embeddings ((metadata->>'document_id'))"),
+    ('idx_embeddings_chunk_id', "public.embeddings ((metadata->>'chunk_id'))"),
+]
+
+
+def advisory_lock_held(conn, key):
+    """Whether any session in this database currently holds the (bigint) advisory lock `key`"""
+    return conn.execute(text("""
+        SELECT 1 FROM pg_locks
+        WHERE locktype = 'advisory' AND granted AND objsubid = 1
+          AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+          AND classid::bigint = (:k >> 32) AND objid::bigint = (:k & 4294967295)
+    """), {'k': key}).first() is not None
+
+
+def pgvector_supports_halfvec(conn):
+    """halfvec indexing and l2_normalize both need pgvector >= 0.7"""
+    ext_version = conn.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar() or '0'
+    return tuple(int(p) for p in ext_version.split('.')[:2] if p.isdigit()) >= (0, 7)
+
+
+def vector_index_spec(use_halfvec, m, ef_construction):
+    """
+    (name, definition, superseded index names) for the embeddings HNSW index.
+    The expression and operator class must match order_expr in match_documents to be used.
+    """
+    params = f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+    if use_halfvec:
+        return ('embeddings_hnsw_halfvec_idx',
+                f'public.embeddings USING hnsw ((embedding::halfvec(384)) halfvec_ip_ops) {params}',
+                ('embeddings_hnsw_idx', 'embeddings_hnsw_ip_idx', 'embeddings_hnsw_cosine_idx'))
+    return ('embeddings_hnsw_cosine_idx',
+            f'public.embeddings USING hnsw (embedding vector_cosine_ops) {params}',
+            ('embeddings_hnsw_idx', 'embeddings_hnsw_ip_idx'))
+
+
+def ensure_index_concurrently(engine, name, definition):
+    """
+    Create an index without blocking writers on the table.
+    CREATE INDEX CONCURRENTLY cannot run inside a transaction, so this uses its own
+    autocommit connection. A build that was interrupted earlier leaves an INVALID index
+    behind, which IF NOT EXISTS would silently keep; those are dropped and rebuilt.
+    """
+    try:
+        with engine.execution_options(isolation_level="AUTOCOMMIT").connect() as conn:
+            # Builds on large tables legitimately outlast the pool's default statement_timeout;
+            # RESET restores the connection default before it goes back to the pool
+            conn.execute(text("SET statement_timeout = 0"))
+            try:
+                is_valid = conn.execute(text("""
+                    SELECT i.indisvalid FROM pg_class c
+                    JOIN pg_index i ON i.indexrelid = c.oid
+                    JOIN pg_namespace n ON n.oid = c.relnamespace
+                    WHERE n.nspname = 'public' AND c.relname = :name
+                """), {'name': name}).scalar()
+
+                if is_valid:
+                    return True
+                if is_valid is False:
+                    logging.warning(f"Index {name} is invalid (interrupted build). Rebuilding...")
+                    conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS public.{name}"))
+
+                conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}"))
+                return True
+            finally:
+                conn.execute(text("RESET statement_timeout"))
+    except Exception as e:
+        logging.warning(f"Failed to create index {name}: {e}")
+        return False
+
+
+def drop_index_concurrently(engine, name):
+    """Drop an index without blocking writers on the table"""
+    try:
+        with engine.execution_options(isolation_level="AUTOCOMMIT").connect() as conn:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS public.{name}"))
+        return True
+    except Exception as e:
+        logging.warning(f"Failed to drop index {name}: {e}")
+        return False
+
+
+def _ensure_with_retries(engine, name, definition, retries, delay):
+    for attempt in range(retries):
+        if ensure_index_concurrently(engine, name, definition):
+            return True
+        time.sleep(delay * (attempt + 1))
+    return False
+
+
+def build_deferred_indexes(engine, retries=3, delay=5, hnsw_m=32, hnsw_ef_construction=200):
+    """
+    Build the embeddings HNSW index and DEFERRED_INDEXES after boot, retrying each a few times.
+    Runs on every boot (valid indexes are a cheap catalog check), so a failed build is retried later.
+    Guarded by an advisory lock so only one worker builds them at a time.
+    """
+    if 'postgresql' not in engine.dialect.name:
+        return
+
+    with engine.connect() as lock_conn:
+        got_lock = lock_conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {'k': DEFERRED_INDEX_LOCK_ID}).scalar()
+        lock_conn.commit()
+        if not got_lock:
+            return
+        try:
+            # A full ANN build can take minutes on a large table, so it never runs inside create_app.
+            # The index must match the mode match_documents was created with (recorded in schema_meta),
+            # not whatever pgvector happens to be installed now
+            with engine.connect() as conn:
+                use_halfvec = conn.execute(text(
+                    "SELECT use_halfvec FROM public.schema_meta ORDER BY version DESC LIMIT 1"
+                )).scalar()
+            if use_halfvec is None:
+                logging.warning("pgvector search mode not recorded yet; skipping the vector index until the next boot")
+            else:
+                name, definition, superseded = vector_index_spec(use_halfvec, hnsw_m, hnsw_ef_construction)
+                if _ensure_with_retries(engine, name, definition, retries, delay):
+                    # Only drop the previous index once its replacement is valid
+                    for old_name in superseded:
+                        drop_index_concurrently(engine, old_name)
+                else:
+                    logging.warning(f"Vector index {name} not built; keeping existing indexes until the next attempt")
+
+            for name, definition in DEFERRED_INDEXES:
+                _ensure_with_retries(engine, name, definition, retries, delay)
+            logging.info("Deferred database indexes verified")
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {'k': DEFERRED_INDEX_LOCK_ID})
+            lock_conn.commit()
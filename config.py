@@ -37,10 +37,15 @@ class Config:
     SQLALCHEMY_ENGINE_OPTIONS = {
         'pool_pre_ping': True,
         'pool_recycle': 280,
-        'pool_size': 10,
-        'max_overflow': 20,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '20')),  # Web workers + refresher + rebuild share this pool
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
         'pool_timeout': 30
     }
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000'))  # 0 disables; fail fast on stuck queries
+    if _DB_URL.startswith('postgresql'):
+        SQLALCHEMY_ENGINE_OPTIONS['connect_args'] = {'application_name': os.getenv('DB_APPLICATION_NAME', 'unibot')}
+        if DB_STATEMENT_TIMEOUT_MS > 0:
+            SQLALCHEMY_ENGINE_OPTIONS['connect_args']['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'
     
     # Supabase
     SUPABASE_URL = os.getenv('SUPABASE_URL')
@@ -51,6 +56,7 @@ class Config:
     # AI Services
     HUGGINGFACE_API_TOKEN = os.getenv('HUGGINGFACE_API_TOKEN')
     HF_EMBEDDING_MODEL = os.getenv('HF_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+    HF_EMBEDDING_ONNX_DIR = os.getenv('HF_EMBEDDING_ONNX_DIR')  # Optional local ONNX export of HF_EMBEDDING_MODEL
     HF_LLM_MODEL = os.getenv('HF_LLM_MODEL', 'Qwen/Qwen3-8B')
     HF_SMALLTALK_MODEL = os.getenv('HF_SMALLTALK_MODEL', 'Qwen/Qwen3-4B-Instruct-2507')
     HF_SYLLABUS_MODEL = os.getenv('HF_SYLLABUS_MODEL', 'Qwen/Qwen3-8B')
@@ -67,12 +73,16 @@ class Config:
     ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD')
 
     # Startup behavior
-    AUTO_REBUILD_INDEX = os.getenv('AUTO_REBUILD_INDEX', 'true').lower() == 'true'
+    # Re-embeds every chunk through the HF API when the vector store is empty at boot (slow, uses API quota)
+    AUTO_REBUILD_INDEX = os.getenv('AUTO_REBUILD_INDEX', 'false').lower() == 'true'
     AUTO_SYNC_STORAGE = os.getenv('AUTO_SYNC_STORAGE', 'true').lower() == 'true'
     SYNC_STORAGE_INTERVAL = int(os.getenv('SYNC_STORAGE_INTERVAL', '120'))
     
     # Retrieval tuning
     VECTOR_MAX_DISTANCE = float(os.getenv('VECTOR_MAX_DISTANCE', '3.0'))  # Permissive threshold for better recall
+    VECTOR_HNSW_M = int(os.getenv('VECTOR_HNSW_M', '32'))  # Graph degree of the pgvector HNSW index
+    VECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv('VECTOR_HNSW_EF_CONSTRUCTION', '200'))
+    VECTOR_HNSW_EF_SEARCH = int(os.getenv('VECTOR_HNSW_EF_SEARCH', '64'))  # Candidate list size per query
 
     # Rate Limiting
     RATELIMIT_DEFAULT = os.getenv('RATELIMIT_DEFAULT', '200 per day; 50 per hour')